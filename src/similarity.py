@@ -3,7 +3,10 @@ from typing import List, Tuple
 
 import numba as nb
 import numpy as np
+import numpy.typing as npt
 import scipy.optimize
+import scipy.sparse
+import scipy.sparse.csgraph
 import spectrum_utils.spectrum as sus
 
 import utils
@@ -12,6 +15,14 @@ import utils
 SpectrumTuple = collections.namedtuple(
     "SpectrumTuple", ["precursor_mz", "precursor_charge", "mz", "intensity"]
 )
+# Numba type of SpectrumTuple, to compile functions with explicit signatures.
+SpectrumTupleType = nb.types.NamedTuple(
+    (nb.float64, nb.int64, nb.float32[::1], nb.float32[::1]), SpectrumTuple
+)
+
+# Maximum size of the cost matrix to compute the optimal peak assignment for
+# the modified cosine similarity using a dense instead of a sparse matrix.
+_DENSE_ASSIGNMENT_MAX_SIZE = 20_000
 
 
 def cosine(
@@ -37,7 +48,143 @@ def cosine(
         A tuple consisting of (i) the cosine similarity between both spectra,
         and (ii) the indexes of matching peaks in both spectra.
     """
-    return _cosine(spectrum1, spectrum2, fragment_mz_tolerance, False)
+    return _cosine(
+        _prepare(spectrum1),
+        _prepare(spectrum2),
+        fragment_mz_tolerance,
+        False,
+    )
+
+
+def cosine_batch(
+    spectra_query: List[sus.MsmsSpectrum],
+    spectra_ref: List[sus.MsmsSpectrum],
+    fragment_mz_tolerance: float,
+) -> np.ndarray:
+    """
+    Compute the binned cosine similarity between all pairs of query and
+    reference spectra.
+
+    Rather than matching individual peaks, peak intensities are summed in m/z
+    bins with the fragment m/z tolerance as width. All similarities are then
+    computed at once as the dot products between the normalized binned
+    spectra.
+
+    Parameters
+    ----------
+    spectra_query : List[sus.MsmsSpectrum]
+        The query spectra.
+    spectra_ref : List[sus.MsmsSpectrum]
+        The reference spectra.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used as m/z bin width.
+
+    Returns
+    -------
+    np.ndarray
+        A matrix with the binned cosine similarity between each query spectrum
+        (rows) and each reference spectrum (columns).
+    """
+    binned_query, binned_ref = _bin_spectra(
+        spectra_query, spectra_ref, fragment_mz_tolerance
+    )
+    return (binned_query @ binned_ref.T).toarray()
+
+
+def cosine_batch_gpu(
+    spectra_query: List[sus.MsmsSpectrum],
+    spectra_ref: List[sus.MsmsSpectrum],
+    fragment_mz_tolerance: float,
+    dtype: npt.DTypeLike = np.float32,
+) -> np.ndarray:
+    """
+    Compute the binned cosine similarity between all pairs of query and
+    reference spectra on the GPU.
+
+    The spectra are binned as in `cosine_batch`, after which the dot products
+    between the binned spectra are computed on the GPU using CuPy.
+
+    Parameters
+    ----------
+    spectra_query : List[sus.MsmsSpectrum]
+        The query spectra.
+    spectra_ref : List[sus.MsmsSpectrum]
+        The reference spectra.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used as m/z bin width.
+    dtype : npt.DTypeLike
+        The data type used for the GPU computations. Use np.float16 for
+        faster computations on GPUs with tensor cores, at the cost of
+        precision.
+
+    Returns
+    -------
+    np.ndarray
+        A matrix with the binned cosine similarity between each query spectrum
+        (rows) and each reference spectrum (columns).
+    """
+    # CuPy is an optional dependency that is only needed for GPU support.
+    import cupy as cp
+
+    binned_query, binned_ref = _bin_spectra(
+        spectra_query, spectra_ref, fragment_mz_tolerance
+    )
+    # Only bins that occur in both the query and the reference spectra
+    # contribute to the similarities, so only those are copied to the GPU as
+    # dense matrices.
+    bins = np.intersect1d(binned_query.indices, binned_ref.indices)
+    query_gpu = cp.asarray(binned_query[:, bins].toarray(), dtype)
+    ref_gpu = cp.asarray(binned_ref[:, bins].toarray(), dtype)
+    return cp.asnumpy(query_gpu @ ref_gpu.T).astype(np.float32)
+
+
+def cosine_many(
+    pairs: List[Tuple[sus.MsmsSpectrum, sus.MsmsSpectrum]],
+    fragment_mz_tolerance: float,
+) -> np.ndarray:
+    """
+    Compute the cosine similarity between many pairs of spectra in parallel.
+
+    Parameters
+    ----------
+    pairs : List[Tuple[sus.MsmsSpectrum, sus.MsmsSpectrum]]
+        The pairs of spectra to compare.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks.
+
+    Returns
+    -------
+    np.ndarray
+        The cosine similarity between the spectra of each pair.
+    """
+    # Collect the peaks of all unique spectra in flat arrays, which can be
+    # processed by Numba without reflecting the Python objects.
+    spectra, spectrum_index = [], {}
+    pair_index = np.empty((len(pairs), 2), np.int64)
+    for pair_i, pair in enumerate(pairs):
+        for spectrum_i, spectrum in enumerate(pair):
+            if id(spectrum) not in spectrum_index:
+                spectrum_index[id(spectrum)] = len(spectra)
+                spectra.append(spectrum)
+            pair_index[pair_i, spectrum_i] = spectrum_index[id(spectrum)]
+    spec_tups = [_prepare(spectrum) for spectrum in spectra]
+    offsets = np.zeros(len(spectra) + 1, np.int64)
+    offsets[1:] = np.cumsum([len(spec_tup.mz) for spec_tup in spec_tups])
+    return _cosine_many(
+        np.asarray([spec_tup.precursor_mz for spec_tup in spec_tups], float),
+        np.asarray([spec_tup.precursor_charge for spec_tup in spec_tups], int),
+        np.concatenate(
+            [np.zeros(0, np.float32)] + [spec_tup.mz for spec_tup in spec_tups]
+        ),
+        np.concatenate(
+            [np.zeros(0, np.float32)]
+            + [spec_tup.intensity for spec_tup in spec_tups]
+        ),
+        offsets,
+        pair_index,
+        fragment_mz_tolerance,
+        False,
+    )
 
 
 def modified_cosine(
@@ -63,42 +210,38 @@ def modified_cosine(
         A tuple consisting of (i) the modified cosine similarity between both
         spectra, and (ii) the indexes of matching peaks in both spectra.
     """
-    intensity1 = np.copy(spectrum1.intensity) / np.linalg.norm(
-        spectrum1.intensity
-    )
-    intensity2 = np.copy(spectrum2.intensity) / np.linalg.norm(
-        spectrum2.intensity
-    )
+    spec_tup1, spec_tup2 = _prepare(spectrum1), _prepare(spectrum2)
+    mz1, intensity1 = spec_tup1.mz, spec_tup1.intensity
+    mz2, intensity2 = spec_tup2.mz, spec_tup2.intensity
 
-    # Only take peak shifts into account if the mass difference is relevant.
-    precursor_charge = max(spectrum1.precursor_charge, 1)
-    precursor_mass_diff = (
-        spectrum1.precursor_mz - spectrum2.precursor_mz
-    ) * precursor_charge
-    num_shifts = 1
-    if abs(precursor_mass_diff) >= fragment_mz_tolerance:
-        num_shifts += precursor_charge
-    mass_diff = np.zeros(num_shifts, np.float32)
-    for charge in range(1, num_shifts):
-        mass_diff[charge] = precursor_mass_diff / charge
+    mass_diff = _mass_diff(
+        spec_tup1.precursor_mz,
+        spec_tup2.precursor_mz,
+        spec_tup1.precursor_charge,
+        fragment_mz_tolerance,
+        True,
+    )
 
-    # Construct pairwise cost matrix.
-    cost = np.zeros((len(spectrum1.mz), len(spectrum2.mz)), np.float32)
-    for i in range(len(spectrum1.mz)):
-        for j in range(len(spectrum2.mz)):
-            for shift in range(num_shifts):
-                if (
-                    abs(spectrum1.mz[i] - (spectrum2.mz[j] + mass_diff[shift]))
-                    <= fragment_mz_tolerance
-                ):
-                    cost[i, j] = max(intensity1[i] * intensity2[j], cost[i, j])
+    # Construct the sparse pairwise cost matrix.
+    num_peaks1, num_peaks2 = len(mz1), len(mz2)
+    indptr, indices, cost = _build_cost(
+        mz1, mz2, intensity1, intensity2, mass_diff, fragment_mz_tolerance
+    )
 
     # Compute optimal assignment.
-    row_ind, col_ind = scipy.optimize.linear_sum_assignment(
-        cost, maximize=True
-    )
-    peak_matches = [(i, j) for i, j in zip(row_ind, col_ind) if cost[i, j] > 0]
-    return cost[row_ind, col_ind].sum(), peak_matches
+    # The sparse matching scales with the number of matching peaks, but has a
+    # higher overhead than the dense matching for small spectra.
+    if num_peaks1 * num_peaks2 <= _DENSE_ASSIGNMENT_MAX_SIZE:
+        row_ind, col_ind = _assign_dense(indptr, indices, cost, num_peaks2)
+    else:
+        row_ind, col_ind = _assign_sparse(indptr, indices, cost, num_peaks2)
+    # Select the cost matrix entries of the assigned peaks.
+    assigned = np.full(num_peaks1, -1)
+    assigned[row_ind] = col_ind
+    peaks1 = np.repeat(np.arange(num_peaks1), np.diff(indptr))
+    matched = (indices == assigned[peaks1]) & (cost > 0)
+    peak_matches = list(zip(peaks1[matched], indices[matched]))
+    return cost[matched].sum(), peak_matches
 
 
 def modified_cosine_greedy(
@@ -124,7 +267,12 @@ def modified_cosine_greedy(
         A tuple consisting of (i) the modified cosine similarity between both
         spectra, and (ii) the indexes of matching peaks in both spectra.
     """
-    return _cosine(spectrum1, spectrum2, fragment_mz_tolerance, True)
+    return _cosine(
+        _prepare(spectrum1),
+        _prepare(spectrum2),
+        fragment_mz_tolerance,
+        True,
+    )
 
 
 def neutral_loss(
@@ -151,9 +299,12 @@ def neutral_loss(
         spectra, and (ii) the indexes of matching peaks in both spectra.
     """
     # Convert peaks to neutral loss.
-    spectrum1 = utils.spec_to_neutral_loss(spectrum1)
-    spectrum2 = utils.spec_to_neutral_loss(spectrum2)
-    return _cosine(spectrum1, spectrum2, fragment_mz_tolerance, False)
+    return _cosine(
+        _prepare(spectrum1, True),
+        _prepare(spectrum2, True),
+        fragment_mz_tolerance,
+        False,
+    )
 
 
 def modified_neutral_loss(
@@ -180,14 +331,137 @@ def modified_neutral_loss(
         spectra, and (ii) the indexes of matching peaks in both spectra.
     """
     # Convert peaks to neutral loss.
-    spectrum1 = utils.spec_to_neutral_loss(spectrum1)
-    spectrum2 = utils.spec_to_neutral_loss(spectrum2)
-    return _cosine(spectrum1, spectrum2, fragment_mz_tolerance, True)
+    return _cosine(
+        _prepare(spectrum1, True),
+        _prepare(spectrum2, True),
+        fragment_mz_tolerance,
+        True,
+    )
+
+
+def _prepare(
+    spectrum: sus.MsmsSpectrum, neutral_loss: bool = False
+) -> SpectrumTuple:
+    """
+    Convert the given spectrum to a Numba-compatible tuple with its peak m/z
+    values and its peak intensities normalized to unit length, both as
+    contiguous float32 arrays.
+
+    The converted spectrum is cached on the spectrum, so that repeated
+    comparisons of the same spectrum only convert it once. Processing the
+    spectrum replaces its peak arrays, after which it is converted again.
+    Peaks that are modified in place are not detected, so such spectra need
+    to be copied or processed instead.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum to be converted.
+    neutral_loss : bool
+        Boolean flag indicating whether to convert the peaks to neutral loss
+        peaks or not.
+
+    Returns
+    -------
+    SpectrumTuple
+        The converted spectrum.
+    """
+    # The cache is keyed on the memory of the peak arrays instead of their
+    # values, which would be slower to compare than converting small spectra
+    # again. It keeps a reference to the original peak arrays, so their
+    # memory can't be reused by new arrays.
+    attr = "_prepared_neutral_loss" if neutral_loss else "_prepared"
+    mz, intensity = spectrum.mz, spectrum.intensity
+    precursor_mz = float(spectrum.precursor_mz)
+    precursor_charge = int(spectrum.precursor_charge)
+    cached = getattr(spectrum, attr, None)
+    if (
+        cached is None
+        or not _same_array(cached[0], mz)
+        or not _same_array(cached[1], intensity)
+        or cached[2].precursor_mz != precursor_mz
+        or cached[2].precursor_charge != precursor_charge
+    ):
+        spectrum_conv = (
+            utils.spec_to_neutral_loss(spectrum) if neutral_loss else spectrum
+        )
+        # The compiled kernels loop over contiguous float32 peak arrays, which
+        # lets Numba vectorize the peak comparisons.
+        cached = (
+            mz,
+            intensity,
+            SpectrumTuple(
+                precursor_mz,
+                precursor_charge,
+                np.ascontiguousarray(spectrum_conv.mz, np.float32),
+                _normalize(
+                    np.ascontiguousarray(spectrum_conv.intensity, np.float32)
+                ),
+            ),
+        )
+        setattr(spectrum, attr, cached)
+    return cached[2]
+
+
+def _same_array(array: np.ndarray, other: np.ndarray) -> bool:
+    """
+    Check whether both arrays are views of the same memory.
+
+    Unlike comparing the array values, this takes constant time.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The first array.
+    other : np.ndarray
+        The second array.
+
+    Returns
+    -------
+    bool
+        True if both arrays have the same shape and overlap in memory, False
+        otherwise.
+    """
+    return array is other or (
+        array.shape == other.shape and np.may_share_memory(array, other)
+    )
+
+
+@nb.njit(fastmath=True, cache=True)
+def _normalize(x: np.ndarray) -> np.ndarray:
+    """
+    Normalize the given vector to unit length.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The vector to be normalized.
+
+    Returns
+    -------
+    np.ndarray
+        A normalized copy of the vector, or zeros if the vector only contains
+        zeros.
+    """
+    # Compute the norm and the normalized vector in a single pass each,
+    # instead of separately copying, squaring, and dividing the vector.
+    s = 0.0
+    for v in x:
+        s += v * v
+    # Empty spectra and spectra without intensity can't be normalized, but
+    # should have a similarity of 0 instead of raising ZeroDivisionError.
+    if s == 0:
+        return np.zeros_like(x)
+    inv_norm = 1.0 / np.sqrt(s)
+    out = np.empty_like(x)
+    for i in range(x.size):
+        out[i] = x[i] * inv_norm
+    return out
 
 
 def _cosine(
-    spectrum1: sus.MsmsSpectrum,
-    spectrum2: sus.MsmsSpectrum,
+    spec_tup1: SpectrumTuple,
+    spec_tup2: SpectrumTuple,
     fragment_mz_tolerance: float,
     allow_shift: bool,
 ) -> Tuple[float, List[Tuple[int, int]]]:
@@ -196,10 +470,10 @@ def _cosine(
 
     Parameters
     ----------
-    spectrum1 : sus.MsmsSpectrum
-        The first spectrum.
-    spectrum2 : sus.MsmsSpectrum
-        The second spectrum.
+    spec_tup1 : SpectrumTuple
+        The first spectrum, converted by `_prepare`.
+    spec_tup2 : SpectrumTuple
+        The second spectrum, converted by `_prepare`.
     fragment_mz_tolerance : float
         The fragment m/z tolerance used to match peaks.
     allow_shift : bool
@@ -211,122 +485,771 @@ def _cosine(
         A tuple consisting of (i) the cosine similarity between both spectra,
         and (ii) the indexes of matching peaks in both spectra.
     """
-    spec_tup1 = SpectrumTuple(
-        spectrum1.precursor_mz,
-        spectrum1.precursor_charge,
-        spectrum1.mz,
-        np.copy(spectrum1.intensity) / np.linalg.norm(spectrum1.intensity),
-    )
-    spec_tup2 = SpectrumTuple(
-        spectrum2.precursor_mz,
-        spectrum2.precursor_charge,
-        spectrum2.mz,
-        np.copy(spectrum2.intensity) / np.linalg.norm(spectrum2.intensity),
-    )
-    return _cosine_fast(
+    # The compiled kernels only work with arrays, the list of matching peaks
+    # is built here.
+    score, peak_match_idx1, peak_match_idx2 = _cosine_fast(
         spec_tup1, spec_tup2, fragment_mz_tolerance, allow_shift
     )
+    return score, list(zip(peak_match_idx1.tolist(), peak_match_idx2.tolist()))
 
 
-@nb.njit
-def _cosine_fast(
-    spec: SpectrumTuple,
-    spec_other: SpectrumTuple,
+@nb.njit(cache=True)
+def _mass_diff(
+    precursor_mz: float,
+    precursor_mz_other: float,
+    precursor_charge: int,
     fragment_mz_tolerance: float,
     allow_shift: bool,
-) -> Tuple[float, List[Tuple[int, int]]]:
+) -> np.ndarray:
     """
-    Compute the cosine similarity between the given spectra.
+    Compute the mass differences by which the peaks of the other spectrum can
+    be shifted.
 
     Parameters
     ----------
-    spec : SpectrumTuple
-        Numba-compatible tuple containing information from the first spectrum.
-    spec_other : SpectrumTuple
-        Numba-compatible tuple containing information from the second spectrum.
+    precursor_mz : float
+        The precursor m/z of the first spectrum.
+    precursor_mz_other : float
+        The precursor m/z of the other spectrum.
+    precursor_charge : int
+        The precursor charge of the first spectrum.
     fragment_mz_tolerance : float
-        The fragment m/z tolerance used to match peaks in both spectra with
-        each other.
+        The fragment m/z tolerance used to match peaks.
     allow_shift : bool
         Boolean flag indicating whether to allow peak shifts or not.
 
     Returns
     -------
-    Tuple[float, List[Tuple[int, int]]]
-        A tuple consisting of (i) the cosine similarity between both spectra,
-        and (ii) the indexes of matching peaks in both spectra.
+    np.ndarray
+        The mass differences, starting with the unshifted mass difference 0.
     """
-    # Find the matching peaks between both spectra, optionally allowing for
-    # shifted peaks.
-    # Candidate peak indices depend on whether we allow shifts
-    # (check all shifted peaks as well) or not.
     # Account for unknown precursor charge (default: 1).
-    precursor_charge = max(spec.precursor_charge, 1)
+    precursor_charge = max(precursor_charge, 1)
     precursor_mass_diff = (
-        spec.precursor_mz - spec_other.precursor_mz
+        precursor_mz - precursor_mz_other
     ) * precursor_charge
     # Only take peak shifts into account if the mass difference is relevant.
     num_shifts = 1
     if allow_shift and abs(precursor_mass_diff) >= fragment_mz_tolerance:
         num_shifts += precursor_charge
-    other_peak_index = np.zeros(num_shifts, np.uint16)
     mass_diff = np.zeros(num_shifts, np.float32)
     for charge in range(1, num_shifts):
         mass_diff[charge] = precursor_mass_diff / charge
+    return mass_diff
 
-    # Find the matching peaks between both spectra.
-    peak_match_scores, peak_match_idx = [], []
-    for peak_index, (peak_mz, peak_intensity) in enumerate(
-        zip(spec.mz, spec.intensity)
-    ):
+
+@nb.njit(fastmath=True, boundscheck=False, cache=True)
+def _find_peak_matches(
+    mz: np.ndarray,
+    mz_other: np.ndarray,
+    intensity: np.ndarray,
+    intensity_other: np.ndarray,
+    fragment_mz_tolerance: float,
+    peak_match_scores: np.ndarray,
+    peak_match_idx1: np.ndarray,
+    peak_match_idx2: np.ndarray,
+) -> int:
+    """
+    Find the matching peaks between both spectra.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The peak m/z values of the first spectrum.
+    mz_other : np.ndarray
+        The peak m/z values of the second spectrum for each shift.
+    intensity : np.ndarray
+        The normalized peak intensities of the first spectrum.
+    intensity_other : np.ndarray
+        The normalized peak intensities of the second spectrum.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+    peak_match_scores : np.ndarray
+        Array in which the scores of the peak matches are stored, as long as
+        it has room.
+    peak_match_idx1 : np.ndarray
+        Array in which the indexes of the matching peaks in the first
+        spectrum are stored, as long as it has room.
+    peak_match_idx2 : np.ndarray
+        Array in which the indexes of the matching peaks in the second
+        spectrum are stored, as long as it has room.
+
+    Returns
+    -------
+    int
+        The number of peak matches.
+    """
+    num_shifts, num_peaks_other = mz_other.shape
+    # Without shifts, the peaks are compared with a single pointer. This is a
+    # separate function, which Numba optimizes better.
+    if num_shifts == 1:
+        return _find_peak_matches_noshift(
+            mz,
+            mz_other[0],
+            intensity,
+            intensity_other,
+            fragment_mz_tolerance,
+            peak_match_scores,
+            peak_match_idx1,
+            peak_match_idx2,
+        )
+    other_peak_index = np.zeros(num_shifts, np.int64)
+    num_matches = 0
+    for peak_index, (peak_mz, peak_intensity) in enumerate(zip(mz, intensity)):
         # Advance while there is an excessive mass difference.
         for cpi in range(num_shifts):
-            while other_peak_index[cpi] < len(spec_other.mz) - 1 and (
+            while other_peak_index[cpi] < num_peaks_other - 1 and (
                 peak_mz - fragment_mz_tolerance
-                > spec_other.mz[other_peak_index[cpi]] + mass_diff[cpi]
+                > mz_other[cpi, other_peak_index[cpi]]
             ):
                 other_peak_index[cpi] += 1
         # Match the peaks within the fragment mass window if possible.
         for cpi in range(num_shifts):
-            index = 0
-            other_peak_i = other_peak_index[cpi] + index
+            other_peak_i = other_peak_index[cpi]
             while (
-                other_peak_i < len(spec_other.mz)
-                and abs(
-                    peak_mz - (spec_other.mz[other_peak_i] + mass_diff[cpi])
-                )
+                other_peak_i < num_peaks_other
+                and abs(peak_mz - mz_other[cpi, other_peak_i])
                 <= fragment_mz_tolerance
             ):
-                peak_match_scores.append(
-                    peak_intensity * spec_other.intensity[other_peak_i]
-                )
-                peak_match_idx.append((peak_index, other_peak_i))
-                index += 1
-                other_peak_i = other_peak_index[cpi] + index
-
-    score, peak_matches = 0.0, []
-    if len(peak_match_scores) > 0:
-        # Use the most prominent peak matches to compute the score (sort in
-        # descending order).
-        peak_match_scores_arr = np.asarray(peak_match_scores)
-        peak_match_order = np.argsort(peak_match_scores_arr)[::-1]
-        peak_match_scores_arr = peak_match_scores_arr[peak_match_order]
-        peak_match_idx_arr = np.asarray(peak_match_idx)[peak_match_order]
-        peaks_used, other_peaks_used = set(), set()
-        for peak_match_score, peak_i, other_peak_i in zip(
-            peak_match_scores_arr,
-            peak_match_idx_arr[:, 0],
-            peak_match_idx_arr[:, 1],
+                if num_matches < len(peak_match_scores):
+                    peak_match_scores[num_matches] = (
+                        peak_intensity * intensity_other[other_peak_i]
+                    )
+                    peak_match_idx1[num_matches] = peak_index
+                    peak_match_idx2[num_matches] = other_peak_i
+                num_matches += 1
+                other_peak_i += 1
+    return num_matches
+
+
+@nb.njit(fastmath=True, boundscheck=False, cache=True)
+def _find_peak_matches_noshift(
+    mz: np.ndarray,
+    mz_other: np.ndarray,
+    intensity: np.ndarray,
+    intensity_other: np.ndarray,
+    fragment_mz_tolerance: float,
+    peak_match_scores: np.ndarray,
+    peak_match_idx1: np.ndarray,
+    peak_match_idx2: np.ndarray,
+) -> int:
+    """
+    Find the matching peaks between both spectra without peak shifts.
+
+    This is `_find_peak_matches` for a single unshifted m/z array, which
+    advances a single pointer over the other peaks.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The peak m/z values of the first spectrum.
+    mz_other : np.ndarray
+        The peak m/z values of the second spectrum.
+    intensity : np.ndarray
+        The normalized peak intensities of the first spectrum.
+    intensity_other : np.ndarray
+        The normalized peak intensities of the second spectrum.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+    peak_match_scores : np.ndarray
+        Array in which the scores of the peak matches are stored, as long as
+        it has room.
+    peak_match_idx1 : np.ndarray
+        Array in which the indexes of the matching peaks in the first
+        spectrum are stored, as long as it has room.
+    peak_match_idx2 : np.ndarray
+        Array in which the indexes of the matching peaks in the second
+        spectrum are stored, as long as it has room.
+
+    Returns
+    -------
+    int
+        The number of peak matches.
+    """
+    num_matches = 0
+    other_peak_index = 0
+    for peak_index, (peak_mz, peak_intensity) in enumerate(zip(mz, intensity)):
+        # Advance while there is an excessive mass difference.
+        while other_peak_index < len(mz_other) - 1 and (
+            peak_mz - fragment_mz_tolerance > mz_other[other_peak_index]
         ):
-            if (
-                peak_i not in peaks_used
-                and other_peak_i not in other_peaks_used
-            ):
-                score += peak_match_score
-                # Save the matched peaks.
-                peak_matches.append((peak_i, other_peak_i))
-                # Make sure these peaks are not used anymore.
-                peaks_used.add(peak_i)
-                other_peaks_used.add(other_peak_i)
-
-    return score, peak_matches
+            other_peak_index += 1
+        # Match the peaks within the fragment mass window if possible.
+        other_peak_i = other_peak_index
+        while (
+            other_peak_i < len(mz_other)
+            and abs(peak_mz - mz_other[other_peak_i]) <= fragment_mz_tolerance
+        ):
+            if num_matches < len(peak_match_scores):
+                peak_match_scores[num_matches] = (
+                    peak_intensity * intensity_other[other_peak_i]
+                )
+                peak_match_idx1[num_matches] = peak_index
+                peak_match_idx2[num_matches] = other_peak_i
+            num_matches += 1
+            other_peak_i += 1
+    return num_matches
+
+
+@nb.njit(fastmath=True, boundscheck=False, cache=True)
+def _match_peaks(
+    spec: SpectrumTuple,
+    spec_other: SpectrumTuple,
+    fragment_mz_tolerance: float,
+    allow_shift: bool,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find all matching peaks between both spectra, optionally allowing for
+    shifted peaks.
+
+    Parameters
+    ----------
+    spec : SpectrumTuple
+        Numba-compatible tuple containing information from the first spectrum.
+    spec_other : SpectrumTuple
+        Numba-compatible tuple containing information from the second spectrum.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+    allow_shift : bool
+        Boolean flag indicating whether to allow peak shifts or not.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        The scores of the peak matches, and the indexes of the matching peaks
+        in the first and in the second spectrum.
+    """
+    mass_diff = _mass_diff(
+        spec.precursor_mz,
+        spec_other.precursor_mz,
+        spec.precursor_charge,
+        fragment_mz_tolerance,
+        allow_shift,
+    )
+    # Shift the other peaks once, instead of for every peak comparison.
+    if len(mass_diff) == 1:
+        mz_other = spec_other.mz.reshape((1, len(spec_other.mz)))
+    else:
+        mz_other = np.empty((len(mass_diff), len(spec_other.mz)), np.float32)
+        for cpi in range(len(mass_diff)):
+            mz_other[cpi] = spec_other.mz + mass_diff[cpi]
+    # Count the matches first to store them in arrays of the exact size.
+    # Growing the arrays while matching instead keeps the arrays alive in the
+    # matching loop, which prevents Numba from optimizing it.
+    num_matches = _find_peak_matches(
+        spec.mz,
+        mz_other,
+        spec.intensity,
+        spec_other.intensity,
+        fragment_mz_tolerance,
+        np.empty(0, np.float32),
+        np.empty(0, np.int32),
+        np.empty(0, np.int32),
+    )
+    peak_match_scores = np.empty(num_matches, np.float32)
+    peak_match_idx1 = np.empty(num_matches, np.int32)
+    peak_match_idx2 = np.empty(num_matches, np.int32)
+    _find_peak_matches(
+        spec.mz,
+        mz_other,
+        spec.intensity,
+        spec_other.intensity,
+        fragment_mz_tolerance,
+        peak_match_scores,
+        peak_match_idx1,
+        peak_match_idx2,
+    )
+    return peak_match_scores, peak_match_idx1, peak_match_idx2
+
+
+@nb.njit(fastmath=True, boundscheck=False, cache=True)
+def _select_peak_matches(
+    num_peaks: int,
+    num_peaks_other: int,
+    peak_match_scores: np.ndarray,
+    peak_match_idx1: np.ndarray,
+    peak_match_idx2: np.ndarray,
+) -> Tuple[float, np.ndarray]:
+    """
+    Greedily select the most prominent peak matches so that each peak is
+    matched at most once.
+
+    Parameters
+    ----------
+    num_peaks : int
+        The number of peaks in the first spectrum.
+    num_peaks_other : int
+        The number of peaks in the second spectrum.
+    peak_match_scores : np.ndarray
+        The scores of the peak matches.
+    peak_match_idx1 : np.ndarray
+        The indexes of the matching peaks in the first spectrum.
+    peak_match_idx2 : np.ndarray
+        The indexes of the matching peaks in the second spectrum.
+
+    Returns
+    -------
+    Tuple[float, np.ndarray]
+        A tuple consisting of (i) the cosine similarity between both spectra,
+        and (ii) the indexes of the selected peak matches.
+    """
+    score = 0.0
+    num_matches = len(peak_match_scores)
+    peaks_used = np.zeros(num_peaks, np.uint8)
+    other_peaks_used = np.zeros(num_peaks_other, np.uint8)
+    # Use the most prominent peak matches to compute the score (sort in
+    # descending order).
+    peak_match_order = np.argsort(peak_match_scores)[::-1]
+    selected = np.empty(num_matches, np.int64)
+    num_selected = 0
+    for i in peak_match_order:
+        peak_i, other_peak_i = peak_match_idx1[i], peak_match_idx2[i]
+        if peaks_used[peak_i] == 0 and other_peaks_used[other_peak_i] == 0:
+            score += peak_match_scores[i]
+            # Save the matched peaks.
+            selected[num_selected] = i
+            num_selected += 1
+            # Make sure these peaks are not used anymore.
+            peaks_used[peak_i] = 1
+            other_peaks_used[other_peak_i] = 1
+    return score, selected[:num_selected]
+
+
+@nb.njit(fastmath=True, boundscheck=False, cache=True)
+def _peak_matches_conflict(
+    num_peaks: int,
+    num_peaks_other: int,
+    peak_match_idx1: np.ndarray,
+    peak_match_idx2: np.ndarray,
+) -> bool:
+    """
+    Check whether any peak takes part in more than one peak match.
+
+    Parameters
+    ----------
+    num_peaks : int
+        The number of peaks in the first spectrum.
+    num_peaks_other : int
+        The number of peaks in the second spectrum.
+    peak_match_idx1 : np.ndarray
+        The indexes of the matching peaks in the first spectrum.
+    peak_match_idx2 : np.ndarray
+        The indexes of the matching peaks in the second spectrum.
+
+    Returns
+    -------
+    bool
+        True if a peak in either spectrum is matched more than once, False
+        otherwise.
+    """
+    peaks_used = np.zeros(num_peaks, np.uint8)
+    other_peaks_used = np.zeros(num_peaks_other, np.uint8)
+    for peak_i, other_peak_i in zip(peak_match_idx1, peak_match_idx2):
+        if peaks_used[peak_i] == 1 or other_peaks_used[other_peak_i] == 1:
+            return True
+        peaks_used[peak_i] = 1
+        other_peaks_used[other_peak_i] = 1
+    return False
+
+
+@nb.njit(
+    nb.types.Tuple((nb.float64, nb.int32[::1], nb.int32[::1]))(
+        SpectrumTupleType, SpectrumTupleType, nb.float64, nb.boolean
+    ),
+    cache=True,
+    fastmath=True,
+    boundscheck=False,
+)
+def _cosine_fast(
+    spec: SpectrumTuple,
+    spec_other: SpectrumTuple,
+    fragment_mz_tolerance: float,
+    allow_shift: bool,
+) -> Tuple[float, np.ndarray, np.ndarray]:
+    """
+    Compute the cosine similarity between the given spectra.
+
+    Parameters
+    ----------
+    spec : SpectrumTuple
+        Numba-compatible tuple containing information from the first spectrum.
+    spec_other : SpectrumTuple
+        Numba-compatible tuple containing information from the second spectrum.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+    allow_shift : bool
+        Boolean flag indicating whether to allow peak shifts or not.
+
+    Returns
+    -------
+    Tuple[float, np.ndarray, np.ndarray]
+        A tuple consisting of (i) the cosine similarity between both spectra,
+        and the indexes of the matching peaks in (ii) the first and (iii) the
+        second spectrum, in descending order of their score.
+    """
+    peak_match_scores, peak_match_idx1, peak_match_idx2 = _match_peaks(
+        spec, spec_other, fragment_mz_tolerance, allow_shift
+    )
+    score, selected = _select_peak_matches(
+        len(spec.mz),
+        len(spec_other.mz),
+        peak_match_scores,
+        peak_match_idx1,
+        peak_match_idx2,
+    )
+    return score, peak_match_idx1[selected], peak_match_idx2[selected]
+
+
+@nb.njit(fastmath=True, boundscheck=False, cache=True)
+def _cosine_fast_score(
+    spec: SpectrumTuple,
+    spec_other: SpectrumTuple,
+    fragment_mz_tolerance: float,
+    allow_shift: bool,
+) -> float:
+    """
+    Compute the cosine similarity between the given spectra, without
+    collecting the matching peaks.
+
+    Parameters
+    ----------
+    spec : SpectrumTuple
+        Numba-compatible tuple containing information from the first spectrum.
+    spec_other : SpectrumTuple
+        Numba-compatible tuple containing information from the second spectrum.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+    allow_shift : bool
+        Boolean flag indicating whether to allow peak shifts or not.
+
+    Returns
+    -------
+    float
+        The cosine similarity between both spectra.
+    """
+    peak_match_scores, peak_match_idx1, peak_match_idx2 = _match_peaks(
+        spec, spec_other, fragment_mz_tolerance, allow_shift
+    )
+    # If all peaks are matched at most once, all peak matches can be used
+    # without having to sort and resolve conflicting matches. This doesn't
+    # pay off when the peak matches are returned, because they still need to
+    # be sorted by score.
+    if not _peak_matches_conflict(
+        len(spec.mz), len(spec_other.mz), peak_match_idx1, peak_match_idx2
+    ):
+        score = 0.0
+        for peak_match_score in peak_match_scores:
+            score += peak_match_score
+        return score
+    return _select_peak_matches(
+        len(spec.mz),
+        len(spec_other.mz),
+        peak_match_scores,
+        peak_match_idx1,
+        peak_match_idx2,
+    )[0]
+
+
+@nb.njit(parallel=True, nogil=True, cache=True)
+def _cosine_many(
+    precursor_mz: np.ndarray,
+    precursor_charge: np.ndarray,
+    mz: np.ndarray,
+    intensity: np.ndarray,
+    offsets: np.ndarray,
+    pairs: np.ndarray,
+    fragment_mz_tolerance: float,
+    allow_shift: bool,
+) -> np.ndarray:
+    """
+    Compute the cosine similarity between many pairs of spectra in parallel.
+
+    Parameters
+    ----------
+    precursor_mz : np.ndarray
+        The precursor m/z of all spectra.
+    precursor_charge : np.ndarray
+        The precursor charge of all spectra.
+    mz : np.ndarray
+        The concatenated peak m/z values of all spectra.
+    intensity : np.ndarray
+        The concatenated normalized peak intensities of all spectra.
+    offsets : np.ndarray
+        The start index of the peaks of each spectrum in the concatenated
+        peak arrays, followed by the total number of peaks.
+    pairs : np.ndarray
+        The indexes of both spectra of each pair.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+    allow_shift : bool
+        Boolean flag indicating whether to allow peak shifts or not.
+
+    Returns
+    -------
+    np.ndarray
+        The cosine similarity between the spectra of each pair.
+    """
+    scores = np.empty(len(pairs), np.float32)
+    for pair_i in nb.prange(len(pairs)):
+        i, j = pairs[pair_i, 0], pairs[pair_i, 1]
+        spec = SpectrumTuple(
+            precursor_mz[i],
+            precursor_charge[i],
+            mz[offsets[i] : offsets[i + 1]],
+            intensity[offsets[i] : offsets[i + 1]],
+        )
+        spec_other = SpectrumTuple(
+            precursor_mz[j],
+            precursor_charge[j],
+            mz[offsets[j] : offsets[j + 1]],
+            intensity[offsets[j] : offsets[j + 1]],
+        )
+        scores[pair_i] = _cosine_fast_score(
+            spec, spec_other, fragment_mz_tolerance, allow_shift
+        )
+    return scores
+
+
+@nb.njit(fastmath=True, cache=True)
+def _match_peak(lo: np.ndarray, hi: np.ndarray, matches: np.ndarray) -> int:
+    """
+    Find the peaks in the other spectrum that match a peak.
+
+    Parameters
+    ----------
+    lo : np.ndarray
+        For each shift, the index of the first matching peak in the other
+        spectrum.
+    hi : np.ndarray
+        For each shift, the index after the last matching peak in the other
+        spectrum.
+    matches : np.ndarray
+        Array in which the indexes of the matching peaks are stored, as long
+        as it has room.
+
+    Returns
+    -------
+    int
+        The number of matching peaks. Peaks that match for multiple shifts
+        are only counted once.
+    """
+    num_matches = 0
+    for shift in range(lo.size):
+        for j in range(lo[shift], hi[shift]):
+            # Skip peaks that were already matched for a previous shift.
+            match = True
+            for prev_shift in range(shift):
+                if lo[prev_shift] <= j < hi[prev_shift]:
+                    match = False
+            if match:
+                if num_matches < matches.size:
+                    matches[num_matches] = j
+                num_matches += 1
+    return num_matches
+
+
+@nb.njit(parallel=True, fastmath=True, cache=True)
+def _build_cost(
+    mz1: np.ndarray,
+    mz2: np.ndarray,
+    intensity1: np.ndarray,
+    intensity2: np.ndarray,
+    mass_diff: np.ndarray,
+    fragment_mz_tolerance: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Construct the sparse pairwise cost matrix between the peaks of two
+    spectra.
+
+    Parameters
+    ----------
+    mz1 : np.ndarray
+        The peak m/z values of the first spectrum.
+    mz2 : np.ndarray
+        The peak m/z values of the second spectrum.
+    intensity1 : np.ndarray
+        The normalized peak intensities of the first spectrum.
+    intensity2 : np.ndarray
+        The normalized peak intensities of the second spectrum.
+    mass_diff : np.ndarray
+        The mass differences by which the peaks of the second spectrum can be
+        shifted.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        The cost matrix in CSR format: the row offsets, the column indexes,
+        and the values of its nonzero entries. The cost of matching peaks is
+        the product of their intensities.
+    """
+    # The m/z window that can match each peak in the first spectrum is found
+    # by a binary search in the shifted peaks of the second spectrum, which
+    # remain sorted.
+    # Explicit loops instead of array expressions avoid that each expression
+    # is parallelized separately, which is slower for typical spectra.
+    num_shifts = mass_diff.size
+    mz2_shifted = np.empty((num_shifts, mz2.size), np.float32)
+    for shift in range(num_shifts):
+        for j in range(mz2.size):
+            mz2_shifted[shift, j] = mz2[j] + mass_diff[shift]
+    lo = np.empty((mz1.size, num_shifts), np.int64)
+    hi = np.empty((mz1.size, num_shifts), np.int64)
+    # Count the matching peaks first, so that the peaks in the first spectrum
+    # can be processed in parallel in both passes.
+    indptr = np.zeros(mz1.size + 1, np.int64)
+    for i in nb.prange(mz1.size):
+        for shift in range(num_shifts):
+            lo[i, shift] = np.searchsorted(
+                mz2_shifted[shift], mz1[i] - fragment_mz_tolerance
+            )
+            hi[i, shift] = np.searchsorted(
+                mz2_shifted[shift],
+                mz1[i] + fragment_mz_tolerance,
+                side="right",
+            )
+        indptr[i + 1] = _match_peak(lo[i], hi[i], np.empty(0, np.int64))
+    indptr = np.cumsum(indptr)
+    indices = np.empty(indptr[-1], np.int64)
+    cost = np.empty(indptr[-1], np.float32)
+    for i in nb.prange(mz1.size):
+        start, stop = indptr[i], indptr[i + 1]
+        _match_peak(lo[i], hi[i], indices[start:stop])
+        cost[start:stop] = intensity1[i] * intensity2[indices[start:stop]]
+    return indptr, indices, cost
+
+
+def _assign_dense(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    cost: np.ndarray,
+    num_peaks_other: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the maximum cost assignment between peaks using a dense cost
+    matrix.
+
+    Parameters
+    ----------
+    indptr : np.ndarray
+        The row offsets of the sparse cost matrix in CSR format.
+    indices : np.ndarray
+        The column indexes of the sparse cost matrix in CSR format.
+    cost : np.ndarray
+        The values of the sparse cost matrix in CSR format.
+    num_peaks_other : int
+        The number of peaks in the other spectrum (columns).
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The indexes of the assigned peaks in both spectra.
+    """
+    dense = np.zeros((len(indptr) - 1, num_peaks_other), np.float32)
+    dense[
+        np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)), indices
+    ] = cost
+    return scipy.optimize.linear_sum_assignment(dense, maximize=True)
+
+
+def _assign_sparse(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    cost: np.ndarray,
+    num_peaks_other: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the maximum cost assignment between peaks using a sparse cost
+    matrix.
+
+    Parameters
+    ----------
+    indptr : np.ndarray
+        The row offsets of the sparse cost matrix in CSR format.
+    indices : np.ndarray
+        The column indexes of the sparse cost matrix in CSR format.
+    cost : np.ndarray
+        The values of the sparse cost matrix in CSR format.
+    num_peaks_other : int
+        The number of peaks in the other spectrum (columns).
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The indexes of the assigned peaks in both spectra. Peaks can be
+        assigned to dummy peaks with an index of at least `num_peaks_other`.
+    """
+    # The matching is a minimum weight full matching: every peak is matched,
+    # either to a peak in the other spectrum with weight 2 - cost, or to its
+    # own dummy peak with weight 2. Minimizing the total weight thus maximizes
+    # the total cost of the matching peaks.
+    num_peaks = len(indptr) - 1
+    dummy_indices = np.arange(num_peaks) + num_peaks_other
+    weights = scipy.sparse.csr_matrix(
+        (
+            np.insert(2.0 - cost.astype(np.float64), indptr[1:], 2.0),
+            np.insert(indices, indptr[1:], dummy_indices),
+            indptr + np.arange(num_peaks + 1),
+        ),
+        shape=(num_peaks, num_peaks + num_peaks_other),
+    )
+    return scipy.sparse.csgraph.min_weight_full_bipartite_matching(weights)
+
+
+def _bin_spectra(
+    spectra1: List[sus.MsmsSpectrum],
+    spectra2: List[sus.MsmsSpectrum],
+    bin_size: float,
+) -> Tuple[scipy.sparse.csr_matrix, scipy.sparse.csr_matrix]:
+    """
+    Convert two sets of spectra to sparse vectors with normalized intensities
+    summed in m/z bins.
+
+    Parameters
+    ----------
+    spectra1 : List[sus.MsmsSpectrum]
+        The first set of spectra.
+    spectra2 : List[sus.MsmsSpectrum]
+        The second set of spectra.
+    bin_size : float
+        The width of the m/z bins.
+
+    Returns
+    -------
+    Tuple[scipy.sparse.csr_matrix, scipy.sparse.csr_matrix]
+        The binned spectra (rows) of both sets, with the same m/z bins
+        (columns).
+    """
+    # Use the same m/z bins for both sets of spectra.
+    bins1 = [
+        np.floor(spec.mz / bin_size).astype(np.int64) for spec in spectra1
+    ]
+    bins2 = [
+        np.floor(spec.mz / bin_size).astype(np.int64) for spec in spectra2
+    ]
+    min_bin = min((b[0] for b in bins1 + bins2 if len(b) > 0), default=0)
+    max_bin = max((b[-1] for b in bins1 + bins2 if len(b) > 0), default=0)
+    num_bins = max_bin - min_bin + 1
+
+    binned = []
+    for spectra, bins in ((spectra1, bins1), (spectra2, bins2)):
+        row = np.repeat(np.arange(len(spectra)), [len(b) for b in bins])
+        col = np.concatenate([np.zeros(0, np.int64), *bins]) - min_bin
+        intensity = np.concatenate(
+            [np.zeros(0, np.float32)] + [spec.intensity for spec in spectra]
+        ).astype(np.float32)
+        # Duplicate entries (peaks in the same bin) are summed.
+        vectors = scipy.sparse.csr_matrix(
+            (intensity, (row, col)), shape=(len(spectra), num_bins)
+        )
+        norm = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)))
+        norm[norm == 0] = 1
+        binned.append(scipy.sparse.csr_matrix(vectors.multiply(1 / norm)))
+    return binned[0], binned[1]
@@ -0,0 +1,302 @@
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+import scipy.optimize
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import similarity  # noqa: E402
+
+
+def _spectrum(mz, intensity, precursor_mz=500.0, precursor_charge=1):
+    return sus.MsmsSpectrum(
+        "test",
+        precursor_mz,
+        precursor_charge,
+        np.asarray(mz, np.float64),
+        np.asarray(intensity, np.float32),
+    )
+
+
+def _assigned_total(dense, row_ind, col_ind):
+    # Peaks assigned to dummy peaks beyond the columns don't contribute.
+    assigned = col_ind < dense.shape[1]
+    row_ind, col_ind = row_ind[assigned], col_ind[assigned]
+    assert len(np.unique(row_ind)) == len(row_ind)
+    assert len(np.unique(col_ind)) == len(col_ind)
+    return dense[row_ind, col_ind].sum()
+
+
+@pytest.mark.parametrize(
+    "num_peaks, num_peaks_other, density",
+    [
+        (1, 1, 1.0),
+        (5, 20, 0.3),
+        (20, 5, 0.3),
+        (50, 50, 0.05),
+        (80, 30, 0.2),
+        (30, 80, 0.2),
+        (10, 10, 0.0),
+    ],
+)
+def test_assign_sparse_equals_dense(num_peaks, num_peaks_other, density):
+    rng = np.random.default_rng(num_peaks * num_peaks_other)
+    for _ in range(20):
+        dense = rng.random((num_peaks, num_peaks_other)).astype(np.float32)
+        dense[rng.random(dense.shape) >= density] = 0
+        # Include peaks without matches.
+        dense[rng.random(num_peaks) < 0.2] = 0
+        rows, indices = np.nonzero(dense)
+        indptr = np.zeros(num_peaks + 1, np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_peaks))
+        cost = dense[rows, indices]
+        expected = dense[
+            scipy.optimize.linear_sum_assignment(dense, maximize=True)
+        ].sum()
+        row_ind, col_ind = similarity._assign_dense(
+            indptr, indices, cost, num_peaks_other
+        )
+        assert _assigned_total(dense, row_ind, col_ind) == pytest.approx(
+            expected, rel=1e-5
+        )
+        row_ind, col_ind = similarity._assign_sparse(
+            indptr, indices, cost, num_peaks_other
+        )
+        # Only matching peaks can be assigned to each other.
+        assigned = col_ind < num_peaks_other
+        assert np.all(dense[row_ind[assigned], col_ind[assigned]] > 0)
+        assert _assigned_total(dense, row_ind, col_ind) == pytest.approx(
+            expected, rel=1e-5
+        )
+
+
+def test_modified_cosine_sparse_equals_dense(monkeypatch):
+    rng = np.random.default_rng(0)
+    pairs = []
+    for num_peaks, num_peaks_other in [(5, 5), (40, 10), (10, 40), (150, 150)]:
+        mz = np.sort(rng.uniform(50, 500, num_peaks))
+        # Match part of the peaks directly and part shifted by the precursor
+        # mass difference.
+        mz_other = np.sort(
+            np.concatenate(
+                (
+                    rng.choice(mz, num_peaks_other // 3) + 0.005,
+                    rng.choice(mz, num_peaks_other // 3) - 15.0,
+                    rng.uniform(50, 500, num_peaks_other // 3 + 1),
+                )
+            )
+        )
+        pairs.append(
+            (
+                _spectrum(mz, rng.uniform(1, 100, len(mz)), 500.0),
+                _spectrum(mz_other, rng.uniform(1, 100, len(mz_other)), 515.0),
+            )
+        )
+    monkeypatch.setattr(similarity, "_DENSE_ASSIGNMENT_MAX_SIZE", np.inf)
+    scores_dense = [
+        similarity.modified_cosine(*pair, 0.02)[0] for pair in pairs
+    ]
+    monkeypatch.setattr(similarity, "_DENSE_ASSIGNMENT_MAX_SIZE", 0)
+    scores_sparse = [
+        similarity.modified_cosine(*pair, 0.02)[0] for pair in pairs
+    ]
+    assert scores_sparse == pytest.approx(scores_dense, rel=1e-5)
+    assert all(score > 0 for score in scores_dense)
+
+
+def test_cosine_processed_spectrum():
+    spectrum1 = _spectrum([100.0, 200.0, 300.0], [1.0, 9.0, 4.0])
+    spectrum2 = _spectrum([100.0, 200.0, 300.0], [1.0, 3.0, 2.0])
+    assert similarity.cosine(spectrum1, spectrum2, 0.1)[0] < 0.98
+    # Processing replaces the peak arrays, which invalidates the cached
+    # conversion of the spectrum.
+    spectrum1.scale_intensity("root")
+    score, _ = similarity.cosine(spectrum1, spectrum2, 0.1)
+    assert score == pytest.approx(1.0, abs=1e-5)
+    spectrum1.filter_intensity(0.5)
+    score, _ = similarity.cosine(spectrum1, spectrum2, 0.1)
+    assert score == pytest.approx(
+        similarity.cosine(
+            _spectrum([200.0, 300.0], [3.0, 2.0]), spectrum2, 0.1
+        )[0]
+    )
+    assert score < 0.98
+
+
+@pytest.mark.parametrize(
+    "score",
+    [
+        "cosine",
+        "modified_cosine",
+        "modified_cosine_greedy",
+        "neutral_loss",
+        "modified_neutral_loss",
+    ],
+)
+@pytest.mark.parametrize(
+    "mz, intensity", [([], []), ([100.0, 200.0], [0.0, 0.0])]
+)
+def test_similarity_without_intensity(score, mz, intensity):
+    spectrum1 = _spectrum(mz, intensity)
+    spectrum2 = _spectrum([100.0, 200.0, 300.0], [1.0, 2.0, 3.0], 510.0)
+    score_func = getattr(similarity, score)
+    assert score_func(spectrum1, spectrum2, 0.05)[0] == 0.0
+    assert score_func(spectrum2, spectrum1, 0.05)[0] == 0.0
+    assert score_func(spectrum1, spectrum1, 0.05)[0] == 0.0
+
+
+def test_cosine_many_without_intensity():
+    spectrum_empty = _spectrum([], [])
+    spectrum_zero = _spectrum([100.0, 200.0], [0.0, 0.0])
+    spectrum = _spectrum([100.0, 200.0, 300.0], [1.0, 2.0, 3.0])
+    scores = similarity.cosine_many(
+        [
+            (spectrum_empty, spectrum),
+            (spectrum_zero, spectrum),
+            (spectrum_empty, spectrum_zero),
+        ],
+        0.05,
+    )
+    np.testing.assert_array_equal(scores, 0.0)
+
+
+def test_cosine_many_equals_cosine():
+    rng = np.random.default_rng(3)
+    centers = rng.uniform(100, 1000, 20)
+    spectra = []
+    for _ in range(8):
+        # Peaks close to the same center match several peaks of the other
+        # spectrum, which gives conflicting peak matches.
+        mz = np.concatenate(
+            [
+                center + rng.uniform(-0.04, 0.04, rng.integers(1, 4))
+                for center in rng.choice(centers, 10, replace=False)
+            ]
+        )
+        mz = np.sort(mz)
+        spectra.append(_spectrum(mz, rng.uniform(1, 100, len(mz))))
+    # Spectra occur in multiple pairs and can be compared to themselves.
+    pairs = [(spectra[i], spectra[j]) for i, j in rng.integers(0, 8, (50, 2))]
+    scores = similarity.cosine_many(pairs, 0.1)
+    assert scores.shape == (50,)
+    for score, pair in zip(scores, pairs):
+        assert score == pytest.approx(
+            similarity.cosine(*pair, 0.1)[0], rel=1e-5
+        )
+    assert scores.min() < 0.5 < scores.max()
+
+
+@pytest.mark.parametrize("allow_shift", [False, True])
+def test_cosine_peak_matches_order(allow_shift):
+    spectrum1 = _spectrum([100.0, 200.0, 300.0, 400.0], [1.0, 4.0, 2.0, 3.0])
+    spectrum2 = _spectrum([100.0, 200.0, 300.0, 400.0], [1.0, 1.0, 1.0, 1.0])
+    score_func = (
+        similarity.modified_cosine_greedy if allow_shift else similarity.cosine
+    )
+    # Without conflicting peak matches.
+    _, peak_matches = score_func(spectrum1, spectrum2, 0.05)
+    assert peak_matches == [(1, 1), (3, 3), (2, 2), (0, 0)]
+    # With conflicting peak matches, which peaks of the second spectrum are
+    # chosen for equal scores is arbitrary.
+    _, peak_matches = score_func(spectrum1, spectrum2, 150.0)
+    assert [peak_i for peak_i, _ in peak_matches] == [1, 3, 2, 0]
+
+
+def _separated_spectra(rng, bins, num_spectra, fragment_mz_tolerance):
+    # Peaks are at least one bin apart from each other and near the middle of
+    # their bin, so the binned and the peak matching cosine similarity agree.
+    spectra = []
+    for _ in range(num_spectra):
+        spectrum_bins = np.sort(rng.choice(bins, rng.integers(5, 30), False))
+        offset = rng.uniform(0.3, 0.7, len(spectrum_bins))
+        mz = (spectrum_bins + offset) * fragment_mz_tolerance
+        spectra.append(_spectrum(mz, rng.uniform(1, 100, len(mz))))
+    return spectra
+
+
+def test_cosine_batch_self_similarity():
+    rng = np.random.default_rng(0)
+    spectra = _separated_spectra(rng, np.arange(2000, 2100, 2), 5, 0.05)
+    scores = similarity.cosine_batch(spectra, spectra, 0.05)
+    np.testing.assert_allclose(np.diag(scores), 1.0, rtol=1e-5)
+
+
+def test_cosine_batch_peaks_same_bin():
+    spectrum1 = _spectrum([100.01, 100.03, 200.06], [1.0, 2.0, 4.0])
+    spectrum2 = _spectrum([100.02, 200.07], [3.0, 4.0])
+    binned1, binned2 = similarity._bin_spectra([spectrum1], [spectrum2], 0.05)
+    assert binned1.nnz == 2
+    np.testing.assert_allclose(binned1.toarray(), binned2.toarray())
+    scores = similarity.cosine_batch([spectrum1], [spectrum2], 0.05)
+    np.testing.assert_allclose(scores, 1.0, rtol=1e-5)
+
+
+def test_cosine_batch_without_intensity():
+    spectrum_empty = _spectrum([], [])
+    spectrum_zero = _spectrum([100.0, 200.0], [0.0, 0.0])
+    spectrum = _spectrum([100.0, 200.0, 300.0], [1.0, 2.0, 3.0])
+    spectra = [spectrum_empty, spectrum_zero, spectrum]
+    scores = similarity.cosine_batch(spectra, spectra, 0.05)
+    np.testing.assert_array_equal(scores[:2], 0.0)
+    np.testing.assert_array_equal(scores[:, :2], 0.0)
+    assert scores[2, 2] == pytest.approx(1.0)
+    scores = similarity.cosine_batch([spectrum_empty], [spectrum_empty], 0.05)
+    np.testing.assert_array_equal(scores, 0.0)
+
+
+def test_cosine_batch_equals_cosine():
+    rng = np.random.default_rng(1)
+    bins = np.arange(2000, 2100, 2)
+    spectra_query = _separated_spectra(rng, bins, 10, 0.05)
+    spectra_ref = _separated_spectra(rng, bins, 8, 0.05)
+    scores = similarity.cosine_batch(spectra_query, spectra_ref, 0.05)
+    assert scores.shape == (10, 8)
+    for i, spectrum_query in enumerate(spectra_query):
+        for j, spectrum_ref in enumerate(spectra_ref):
+            assert scores[i, j] == pytest.approx(
+                similarity.cosine(spectrum_query, spectrum_ref, 0.05)[0],
+                abs=1e-5,
+            )
+    assert scores.max() > 0.3
+
+
+@pytest.fixture
+def cupy_numpy(monkeypatch):
+    # Let NumPy stand in for CuPy to test the GPU code without a GPU.
+    cupy = types.SimpleNamespace(asarray=np.asarray, asnumpy=np.asarray)
+    monkeypatch.setitem(sys.modules, "cupy", cupy)
+
+
+@pytest.mark.parametrize(
+    "dtype, rtol", [(np.float32, 1e-5), (np.float16, 1e-2)]
+)
+def test_cosine_batch_gpu(cupy_numpy, dtype, rtol):
+    rng = np.random.default_rng(2)
+    bins = np.arange(2000, 2100, 2)
+    spectra_query = _separated_spectra(rng, bins, 10, 0.05)
+    spectra_ref = _separated_spectra(rng, bins, 8, 0.05)
+    scores = similarity.cosine_batch_gpu(
+        spectra_query, spectra_ref, 0.05, dtype
+    )
+    assert scores.dtype == np.float32
+    np.testing.assert_allclose(
+        scores,
+        similarity.cosine_batch(spectra_query, spectra_ref, 0.05),
+        rtol=rtol,
+        atol=rtol,
+    )
+
+
+def test_cosine_batch_gpu_no_shared_bins(cupy_numpy):
+    spectra_query = [
+        _spectrum([100.0, 200.0], [1.0, 2.0]),
+        _spectrum([150.0], [1.0]),
+    ]
+    spectra_ref = [_spectrum([300.0, 400.0], [1.0, 2.0])]
+    scores = similarity.cosine_batch_gpu(spectra_query, spectra_ref, 0.05)
+    assert scores.shape == (2, 1)
+    np.testing.assert_array_equal(scores, 0.0)